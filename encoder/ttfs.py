@@ -1,5 +1,7 @@
 import json
 import numpy as np
+import pandas as pd
+from numba import njit, prange
 
 
 
@@ -11,86 +13,227 @@ NUM_RINGS = 5
 RING_WIDTH = MAX_DELAY_MS / NUM_RINGS
 # Максимально возможное колебание времени, мс
 JITTER_FRAC = 0.005
-# Фиксация рандома
-RAND = np.random.RandomState(42)
+# Фиксация рандома (генератор PCG64, колебания генерируются одним вызовом на запись/пакет)
+RAND = np.random.default_rng(42)
 # Степени нелинейности для каждого из колец
 GAMMAS = [1.05, 1.10, 1.15, 1.20, 1.25]
+# Размер таблицы значений norm**gamma на отрезке [0, 1]
+LUT_SIZE = 4096
+# Количество тиков в 1 мс (время спайка квантуется с шагом 1 мкс)
+TICKS_PER_MS = 1000
+# Сдвиг индекса канала в упакованном спайке (младшие 16 бит - время в тиках)
+CHANNEL_SHIFT = 16
 
 
 
-# Загрузка json-файла с min/max диапазонами признаков
+# Загрузка npz-файла (или json-файла) с min/max диапазонами признаков
+# Возвращает тройку (names, lo, hi), упорядоченную по наименованию признака
 def load_feature_ranges(path):
     if not path.exists():
         raise FileNotFoundError(path)
+    # npz-файл уже содержит готовые массивы
+    if path.suffix == ".npz":
+        with np.load(path) as data:
+            return data["names"].tolist(), data["lo"], data["hi"]
     with path.open(encoding="utf-8") as f:
         feature_ranges = json.load(f)
-    # Формирование словаря вида {"название признака": (min_value, max_value)}
-    return {k: (float(v[0]), float(v[1])) for k, v in feature_ranges.items()}
+    names = sorted(feature_ranges)
+    lo = np.array([float(feature_ranges[name][0]) for name in names], dtype=np.float64)
+    hi = np.array([float(feature_ranges[name][1]) for name in names], dtype=np.float64)
+    return names, lo, hi
+
+
+# Распаковка спайка (или массива спайков) вида (канал << CHANNEL_SHIFT) | тик
+# Возвращает пару (канал, время в мс)
+def decode_spike(spike):
+    return spike >> CHANNEL_SHIFT, (spike & ((1 << CHANNEL_SHIFT) - 1)) / TICKS_PER_MS
+
+
+
+# Кодирование пакета записей в спайки за один проход по данным
+# (нормализация, нелинейность, колебание, ограничение и сортировка по времени
+# выполняются в одном цикле, строки обрабатываются параллельно)
+# Упакованные спайки i-й записи записываются в начало строки out_spikes[i],
+# их количество - в out_counts[i]
+@njit(parallel=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"}, boundscheck=False)
+def _encode_kernel(
+        values,         # матрица значений признаков размера (N, n_feats)
+        mins,           # нижние границы диапазонов признаков
+        deltas,         # ширины диапазонов признаков
+        valid_mask,     # маска признаков с ненулевой шириной диапазона
+        gamma_lut,      # таблицы значений norm**gamma размера (NUM_RINGS, LUT_SIZE)
+        jitter,         # случайные колебания размера (N, n_feats, NUM_RINGS), мс
+        skip_zeros,     # пропускать ли нулевые значения
+        out_spikes,     # выходной буфер упакованных спайков размера (N, n_feats * NUM_RINGS)
+        out_counts      # выходной буфер количества спайков в записях размера (N,)
+    ):
+    n_rows, n_feats = values.shape
+    n_rings, lut_size = gamma_lut.shape
+    for i in prange(n_rows):
+        # Задержки в тиках и каналы спайков записи в порядке (признак, кольцо)
+        row_ticks = np.empty(n_feats * n_rings, dtype=np.uint16)
+        row_channels = np.empty(n_feats * n_rings, dtype=np.int32)
+        count = 0
+        for f in range(n_feats):
+            norm = min(max((values[i, f] - mins[f]) / deltas[f], 0.0), 1.0)
+            if not valid_mask[f] or (skip_zeros and not norm > 1e-9):
+                continue
+            # Позиция значения в таблице и доля для линейной интерполяции
+            pos = norm * (lut_size - 1)
+            idx = min(int(pos), lut_size - 2)
+            frac = pos - idx
+            for r in range(n_rings):
+                powed = gamma_lut[r, idx] + frac * (gamma_lut[r, idx + 1] - gamma_lut[r, idx])
+                delay = MAX_DELAY_MS * (1.0 - powed) + jitter[i, f, r]
+                row_ticks[count] = np.uint16(np.rint(min(max(delay, 0.0), MAX_DELAY_MS) * TICKS_PER_MS))
+                row_channels[count] = r * n_feats + f
+                count += 1
+
+        # Стабильная сортировка спайков записи по времени
+        order = np.argsort(row_ticks[:count], kind="mergesort")
+        for k in range(count):
+            out_spikes[i, k] = (
+                (np.uint32(row_channels[order[k]]) << np.uint32(CHANNEL_SHIFT))
+                | np.uint32(row_ticks[order[k]])
+            )
+        out_counts[i] = count
 
 
 
 def build_encoder(
-    feature_ranges,         # словарь диапазонов значений признаков
+    feature_ranges,         # тройка (names, lo, hi) или словарь {"признак": (min, max)}
     skip_zeros=True         # пропускать ли нулевые значения при кодировании
 ):
     assert len(GAMMAS) == NUM_RINGS, "Длина GAMMAS должна быть равна NUM_RINGS"
+    assert MAX_DELAY_MS * TICKS_PER_MS < 1 << CHANNEL_SHIFT, "Время в тиках должно помещаться в 16 бит"
+
+    # Приведение словаря диапазонов к тройке (names, lo, hi)
+    if isinstance(feature_ranges, dict):
+        feature_ranges = (
+            list(feature_ranges),
+            [val[0] for val in feature_ranges.values()],
+            [val[1] for val in feature_ranges.values()]
+        )
+    names, lo, hi = feature_ranges
 
     # Сортировка признаков по их наименованию в алфавитном порядке
-    num_cols = sorted(feature_ranges)
+    order = sorted(range(len(names)), key=lambda i: names[i])
+    num_cols = [names[i] for i in order]
     # Количество признаков
     n_feats = len(num_cols)
 
-    # Вычисление индекса канала (входного нейрона) для признака
-    def calc_channel_idx(
-            feature_idx,        # индекс признака в отсортированном датасете
-            ring_idx            # индекс кольца
+    # Нижние границы и ширины диапазонов признаков в порядке num_cols
+    mins = np.asarray(lo, dtype=np.float64)[order]
+    deltas = np.asarray(hi, dtype=np.float64)[order] - mins
+    # Признаки со слишком малой разницей min/max не кодируются
+    valid_mask = deltas >= 1e-9
+    # Защита от деления на ноль для таких признаков
+    deltas = np.where(valid_mask, deltas, 1.0)
+    # Таблицы значений norm**gamma для каждого кольца (вместо возведения в дробную
+    # степень при кодировании используется линейная интерполяция по таблице)
+    gamma_lut = (
+        np.linspace(0.0, 1.0, LUT_SIZE)[None, :] ** np.asarray(GAMMAS)[:, None]
+    ).astype(np.float32)
+    # Матрица индексов каналов (входных нейронов) размера (n_feats, NUM_RINGS):
+    # channels[feature_idx, ring_idx] = ring_idx * n_feats + feature_idx
+    channels = np.arange(NUM_RINGS)[None, :] * n_feats + np.arange(n_feats)[:, None]
+
+
+    # TTFS-кодирование вектора значений признаков в спайки
+    # (values[i] соответствует признаку num_cols[i])
+    def encode_from_array(
+            values      # вектор значений признаков одной записи
         ):
-        return ring_idx * n_feats + feature_idx
+        # Нормализация значений признаков
+        norm = np.clip((values - mins) / deltas, 0.0, 1.0)
+
+        # Маска кодируемых признаков (если установлен флаг "не кодировать нули",
+        # значения близкие к 0 пропускаются)
+        keep = valid_mask & (norm > 1e-9) if skip_zeros else valid_mask
+        norm = norm[keep]
+
+        # Значения norm**gamma для каждого из NUM_RINGS колец (интерполяция по таблице)
+        pos = norm * (LUT_SIZE - 1)
+        idx = np.minimum(pos.astype(np.int64), LUT_SIZE - 2)
+        frac = (pos - idx)[:, None]
+        lut_lo, lut_hi = gamma_lut[:, idx].T, gamma_lut[:, idx + 1].T
+        # Задержки в мс для каждого признака в каждом кольце
+        # (чем больше значение, тем раньше спайк)
+        delays = MAX_DELAY_MS * (1.0 - (lut_lo + frac * (lut_hi - lut_lo)))
+        # Случайное колебание
+        delays += RAND.uniform(-JITTER_FRAC * MAX_DELAY_MS, JITTER_FRAC * MAX_DELAY_MS, size=delays.shape)
+        np.clip(delays, 0.0, MAX_DELAY_MS, out=delays)
+
+        # Квантование времени до тиков
+        ticks = np.rint(delays.ravel() * TICKS_PER_MS).astype(np.uint16)
+        # Сортировка спайков по времени (стабильная, для uint16 - поразрядная)
+        order = np.argsort(ticks, kind="stable")
+        # Массив упакованных спайков вида (канал << CHANNEL_SHIFT) | тик
+        return (channels[keep].ravel()[order].astype(np.uint32) << CHANNEL_SHIFT) | ticks[order]
 
 
     # TTFS-кодирование записи датасета в спайки
     def encode(
-            record      # одна запись из датасета
+            record      # одна запись из датасета (np.ndarray, pandas Series или dict)
         ):
-        # Список кортежей спайков вида (канал, время)
-        spikes = []
-
-        # feat_idx - индекс признака, col_name - наименование колонки
-        for feat_idx, col_name in enumerate(num_cols):
-            # Извлекаем диапазоны признака
-            min_value, max_value = feature_ranges[col_name]
-            # Если разница слишком мала, пропускаем
-            delta_value = max_value - min_value
-            if delta_value < 1e-9:
-                continue
-
-            # Нормализация значения признака
-            norm_value = (float(record[col_name]) - min_value) / delta_value
-            norm_value = np.clip(norm_value, 0.0, 1.0)
-            
-            # Если установлен флаг "не кодировать нули" и norm_value близко к 0, пропускаем
-            if skip_zeros and norm_value <= 1e-9:
-                continue
-
-            # Кодируем спайки с задержками в каждое из NUM_RINGS колец
-            for r_idx in range(NUM_RINGS):
-                gamma = GAMMAS[r_idx]
-                # Вычисление задержки в мс (чем больше значение, тем раньше спайк)
-                delay = MAX_DELAY_MS * (1.0 - norm_value**gamma)
-                # Случайное колебание
-                delay += RAND.uniform(-JITTER_FRAC, JITTER_FRAC) * MAX_DELAY_MS 
-                delay = np.clip(delay, 0.0, MAX_DELAY_MS)
-                # Обновляем список спайков
-                spikes.append((calc_channel_idx(feat_idx, r_idx), delay))
-
-        # Сортировка спайков по времени
-        spikes.sort(key=lambda x: x[1])
-        return np.asarray(spikes, dtype=np.float32)
+        # Вектор уже упорядочен по num_cols
+        if isinstance(record, np.ndarray):
+            values = record
+        # Series переупорядочивается по num_cols одним вызовом
+        # (отсутствующий признак приводит к KeyError)
+        elif isinstance(record, pd.Series):
+            values = record[num_cols].to_numpy(dtype=np.float64)
+        else:
+            values = np.array([record[col_name] for col_name in num_cols], dtype=np.float64)
+        return encode_from_array(np.asarray(values, dtype=np.float64))
+
+
+    # TTFS-кодирование сразу всех записей датасета
+    # Возвращает пару (spikes, row_offsets): упакованные спайки i-й записи -
+    # spikes[row_offsets[i]:row_offsets[i + 1]]
+    def encode_batch(
+            df          # pandas DataFrame или матрица значений признаков в порядке num_cols
+        ):
+        # Матрица значений признаков размера (N, n_feats)
+        if isinstance(df, np.ndarray):
+            values = np.ascontiguousarray(df, dtype=np.float64)
+        else:
+            values = df[num_cols].to_numpy(dtype=np.float64)
+        n_rows = values.shape[0]
+
+        # Случайные колебания для всех спайков пакета
+        jitter = RAND.uniform(
+            -JITTER_FRAC * MAX_DELAY_MS, JITTER_FRAC * MAX_DELAY_MS, size=(n_rows, n_feats, NUM_RINGS)
+        )
+
+        # Буферы для отсортированных спайков всех записей
+        out_spikes = np.empty((n_rows, n_feats * NUM_RINGS), dtype=np.uint32)
+        counts = np.empty(n_rows, dtype=np.int64)
+        _encode_kernel(
+            values, mins, deltas, valid_mask, gamma_lut, jitter, skip_zeros,
+            out_spikes, counts
+        )
+
+        # Смещения записей в общих массивах
+        row_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(counts, out=row_offsets[1:])
+
+        # Отбрасывание незаполненных хвостов строк
+        valid = np.arange(n_feats * NUM_RINGS)[None, :] < counts[:, None]
+        return out_spikes[valid], row_offsets
 
     # Общее количество входных нейронов
     encode.num_neurons = NUM_RINGS * n_feats
     # Упорядоченный набор наименований признаков
     encode.feature_list = num_cols
+    # Позиции признаков во входном векторе
+    encode.feature_indices = {name: i for i, name in enumerate(num_cols)}
+    # Кодирование вектора значений, упорядоченного по feature_list
+    # (для обработки датасета целиком лучше один раз получить df[feature_list].to_numpy()
+    # и передавать строки матрицы или всю матрицу в encode_batch)
+    encode.encode_from_array = encode_from_array
+    # Пакетное кодирование всего датасета
+    encode.encode_batch = encode_batch
 
     return encode
 
@@ -1,5 +1,6 @@
 import json
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
 
 # Пути к тренировочному и тестовому датасетам 
@@ -10,23 +11,43 @@ REMOVED_PATH = Path("analysis/features_analysis/removed_features.json")
 # Пути для сохранения файлов без лишних колонок
 TRAIN_OUT = Path("data/split/train_clean.parquet")
 TEST_OUT = Path("data/split/test_clean.parquet")
+# Параметры записи файлов без лишних колонок (те же, что и в prepare_dataset.py)
+PARQUET_OPTIONS = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "use_dictionary": ["Label"],
+    "data_page_size": 1 << 20,
+    "write_statistics": True
+}
+
+
+# Потоковое копирование parquet-файла без лишних колонок (по группам строк)
+# Возвращает размеры исходной и итоговой таблицы
+def copy_without_columns(
+        in_path,        # путь к исходному parquet-файлу
+        out_path,       # путь для сохранения файла без лишних колонок
+        removed         # список наименований удаляемых колонок
+    ):
+    pf = pq.ParquetFile(in_path)
+    schema = pf.schema_arrow
+    # Читаются только нужные колонки (лишние не распаковываются)
+    keep_cols = [col for col in schema.names if col not in removed]
+    new_schema = pa.schema([schema.field(col) for col in keep_cols], metadata=schema.metadata)
+    with pq.ParquetWriter(out_path, new_schema, **PARQUET_OPTIONS) as writer:
+        for rg in range(pf.num_row_groups):
+            writer.write_table(pf.read_row_group(rg, columns=keep_cols))
+    n_rows = pf.metadata.num_rows
+    return (n_rows, len(schema.names)), (n_rows, len(keep_cols))
 
 
 with REMOVED_PATH.open(encoding="utf-8") as f:
     removed_features = json.load(f)
-train_df = pd.read_parquet(TRAIN_IN)
-test_df = pd.read_parquet(TEST_IN)
-print(f"train.parquet: {train_df.shape}")
-print(f"test.parquet : {test_df.shape}")
-
-# Удаление колонок
-train_df_clean = train_df.drop(columns=[col for col in removed_features if col in train_df.columns])
-test_df_clean = test_df.drop(columns=[col for col in removed_features if col in test_df.columns])
 
-# Сохранение
-train_df_clean.to_parquet(TRAIN_OUT, index=False)
-test_df_clean.to_parquet(TEST_OUT, index=False)
+train_shape, train_clean_shape = copy_without_columns(TRAIN_IN, TRAIN_OUT, removed_features)
+test_shape, test_clean_shape = copy_without_columns(TEST_IN, TEST_OUT, removed_features)
 
+print(f"train.parquet: {train_shape}")
+print(f"test.parquet : {test_shape}")
 print(f"Удалено {len(removed_features)} признаков")
-print(f"train_clean.parquet: {train_df_clean.shape}")
-print(f"test_clean.parquet : {test_df_clean.shape}")
+print(f"train_clean.parquet: {train_clean_shape}")
+print(f"test_clean.parquet : {test_clean_shape}")
@@ -1,10 +1,20 @@
+import csv
+import functools
 import json
+import multiprocessing
+import os
 import pathlib
 import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
 import pyarrow.parquet as pq
+from numba import njit, prange, set_num_threads
 
 
 # Папка с исходными csv
@@ -19,8 +29,13 @@ POSSIBLE_ENCODINGS = (
 )
 
 
-# Максимальное количество строк, обрабатываемых за раз при потоковой обработке
-NUM_STR = 100000
+# Размер блока (в байтах), читаемого за раз при потоковой обработке
+BLOCK_SIZE = 64 << 20
+# Строковые значения, которые при чтении csv считаются пропусками
+# (бесконечности удаляются так же, как и NaN)
+NULL_VALUES = ["", "NaN", "nan", "inf", "-inf", "Infinity", "-Infinity"]
+# Шаблон корректной записи числа (после удаления разделителей тысяч)
+NUMBER_PATTERN = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
 # Столбцы, которые удаляем
 DROP_COLS = [
     "Flow ID",                      # номер записи не содержит полезной информации для классификации
@@ -47,6 +62,12 @@ LABEL_MAP = {
     "Web Attack - XSS": "WebAttack",
     "Web Attack - Sql Injection": "WebAttack"
 }
+# Группы меток трафика (категории колонки Label)
+LABEL_GROUPS = sorted(set(LABEL_MAP.values()))
+# Исходные метки и коды соответствующих им групп в виде массивов arrow
+# (для сопоставления меток без перехода к pandas)
+LABEL_KEYS = pa.array(list(LABEL_MAP))
+LABEL_CODES = pa.array([LABEL_GROUPS.index(group) for group in LABEL_MAP.values()], type=pa.int8())
 
 # Список признаков с чрезмерно широким диапазоном min/max значений
 WIDE_RANGE_FEATURES = {
@@ -79,130 +100,295 @@ WIDE_RANGE_FEATURES = {
     "Avg Fwd Segment Size",
     "Avg Bwd Segment Size"
 }
+# Параметры записи итогового parquet-файла (метки сжимаются словарем,
+# статистики позволяют пропускать группы строк при чтении с фильтром)
+PARQUET_OPTIONS = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "use_dictionary": ["Label"],
+    "data_page_size": 1 << 20,
+    "write_statistics": True
+}
+# Пометка в метаданных parquet о формате колонки Timestamp
+TIMESTAMP_METADATA = {b"Timestamp": b"int64 ns since epoch"}
 # Шаблон для определения наименований признаков, которые могут иметь широкий диапазон
 WR_AUTODETECT_PATTERN = re.compile(r"(Duration|IAT|Active|Idle|Bytes/s|Packets/s|Variance)", re.I)
 
 
 
-# Защита от экстремальных выбросов в значениях числовых признаков
-# (ограничение значений по перцентилям)
-def _clip_by_percentiles(
-        df,             # pandas DataFrame с признаками
-        col_names       # список наименований колонок, в которых нужно устранить выбросы
+# Границы ограничения значений по перцентилям 0.1% и 99.9% до и после логарифмирования
+# Ограничение и логарифм монотонны, поэтому порядковые статистики преобразованных
+# значений - это преобразованные порядковые статистики исходных, и все границы
+# вычисляются по одной частичной сортировке
+def _clip_bounds(
+        values,         # матрица значений признаков (без пропусков)
+        wide_mask       # маска колонок с широким диапазоном значений
     ):
-    for name in col_names:
-        val_min, val_max = df[name].quantile([0.001, 0.999])
-        df[name] = df[name].clip(val_min, val_max)
-    return df
+    # Позиции перцентилей в отсортированной колонке (линейная интерполяция, как в np.quantile)
+    pos = (values.shape[0] - 1) * np.array([0.001, 0.999])
+    lo_idx = np.floor(pos).astype(np.int64)
+    hi_idx = np.minimum(lo_idx + 1, values.shape[0] - 1)
+    frac = (pos - lo_idx)[:, None]
+
+    # Соседние порядковые статистики для каждого перцентиля, размер (2, n_cols)
+    part = np.partition(values, np.unique(np.concatenate([lo_idx, hi_idx])), axis=0)
+    stat_lo, stat_hi = part[lo_idx], part[hi_idx]
+
+    # Границы первого ограничения
+    clip_lo, clip_hi = stat_lo + frac * (stat_hi - stat_lo)
+
+    # Те же порядковые статистики после ограничения и логарифмирования
+    stat_lo = np.clip(stat_lo, clip_lo, clip_hi)
+    stat_hi = np.clip(stat_hi, clip_lo, clip_hi)
+    stat_lo[:, wide_mask] = np.log10(np.maximum(stat_lo[:, wide_mask], 0) + 1)
+    stat_hi[:, wide_mask] = np.log10(np.maximum(stat_hi[:, wide_mask], 0) + 1)
+
+    # Границы повторного ограничения
+    log_lo, log_hi = stat_lo + frac * (stat_hi - stat_lo)
+    return clip_lo, clip_hi, log_lo, log_hi
+
+
+# Ограничение, логарифмирование и повторное ограничение значений с одновременным
+# поиском min/max каждой колонки за один проход по данным (колонки обрабатываются параллельно)
+@njit(parallel=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+def _transform_kernel(
+        values,         # матрица значений признаков (изменяется на месте)
+        clip_lo,        # нижние границы первого ограничения
+        clip_hi,        # верхние границы первого ограничения
+        log_lo,         # нижние границы повторного ограничения
+        log_hi,         # верхние границы повторного ограничения
+        wide_mask,      # маска колонок с широким диапазоном значений
+        out_min,        # выходной буфер min значений колонок
+        out_max         # выходной буфер max значений колонок
+    ):
+    n_rows, n_cols = values.shape
+    for j in prange(n_cols):
+        col_min, col_max = np.inf, -np.inf
+        for i in range(n_rows):
+            v = min(max(values[i, j], clip_lo[j]), clip_hi[j])
+            if wide_mask[j]:
+                v = np.log10(max(v, 0.0) + 1.0)
+            v = min(max(v, log_lo[j]), log_hi[j])
+            values[i, j] = v
+            col_min = min(col_min, v)
+            col_max = max(col_max, v)
+        out_min[j] = col_min
+        out_max[j] = col_max
 
 
-# Логарифмирование и ограничение значений числовых признаков с широким диапазоном
-def _log_and_clip_scaling(
-        df,             # pandas DataFrame с признаками
+# Защита от экстремальных выбросов в значениях числовых признаков
+# (ограничение значений по перцентилям, логарифмирование признаков с широким
+# диапазоном и повторное ограничение)
+# Возвращает обработанный DataFrame и min/max значения каждой колонки
+def _scale_features(
+        df,             # pandas DataFrame с признаками (без пропусков)
         col_names       # список наименований колонок, в которых нужно устранить выбросы
     ):
-    for name in col_names:
-        if name in WIDE_RANGE_FEATURES or WR_AUTODETECT_PATTERN.search(name):
-            df[name] = np.log10(df[name].clip(lower=0) + 1)
-        val_min, val_max = df[name].quantile([0.001, 0.999])
-        df[name] = df[name].clip(val_min, val_max)
-    return df
+    col_names = list(col_names)
+    # Копия значений, расположенная по колонкам
+    values = np.array(df[col_names].to_numpy(dtype=np.float64), order="F")
+    # Маска колонок с широким диапазоном значений
+    wide_mask = np.array(
+        [name in WIDE_RANGE_FEATURES or bool(WR_AUTODETECT_PATTERN.search(name)) for name in col_names],
+        dtype=bool
+    )
 
+    clip_lo, clip_hi, log_lo, log_hi = _clip_bounds(values, wide_mask)
+    col_min = np.empty(len(col_names), dtype=np.float64)
+    col_max = np.empty(len(col_names), dtype=np.float64)
+    _transform_kernel(values, clip_lo, clip_hi, log_lo, log_hi, wide_mask, col_min, col_max)
 
+    df[col_names] = values
+    return df, col_min, col_max
 
 
-# Обработка одного csv-файла
-def _process_csv(
-        csv_path,               # путь к одному из csv-файлов исходного датасета
-        writer,                 # объект для записи данных в parquet
-        global_minmax           # словарь min/max значений каждого числового признака
-    ):
-    print(f"[PROCESS] Обрабатывается {csv_path.name}")
 
-    # Перебор возможных кодировок
-    for enc in POSSIBLE_ENCODINGS:
-        try:
-            # Флаг корректной обработки данных
-            prcs_ok = True
 
-            # Чтение файла фрагментами размером NUM_STR
-            reader = pd.read_csv(csv_path, chunksize=NUM_STR, low_memory=False, encoding=enc)
+# Приведение временных меток к int64 (наносекунды с начала эпохи)
+def _to_epoch_ns(
+        timestamps      # pandas Series с временными метками datetime без пропусков
+    ):
+    return timestamps.astype("datetime64[ns]").astype("int64")
+
+
+# Переименование повторяющихся наименований колонок так же, как это делает pandas
+# (вторая копия "name" становится "name.1", третья - "name.2" и т.д.)
+def _dedup_names(names):
+    seen = set()
+    new_names = []
+    for name in names:
+        new_name, idx = name, 0
+        while new_name in seen:
+            idx += 1
+            new_name = f"{name}.{idx}"
+        seen.add(new_name)
+        new_names.append(new_name)
+    return new_names
+
+
+# Открытие csv-файла для потоковой обработки
+# Лишние колонки не читаются, все остальные читаются как строки
+# (числовые признаки приводятся к float64 поблочно в _to_float)
+def _open_csv(
+        csv_path,               # путь к одному из csv-файлов исходного датасета
+        enc                     # кодировка файла
+    ):
+    # Чтение заголовка для составления схемы
+    # (BOM в начале utf-8 файла не должен попасть в имя первой колонки)
+    with csv_path.open(encoding="utf-8-sig" if enc == "utf-8" else enc, newline="") as f:
+        header = _dedup_names(next(csv.reader(f)))
+
+    # Колонки, которые нужно прочитать
+    keep_cols = [col for col in header if col.strip() not in DROP_COLS]
+    col_types = {col: pa.string() for col in keep_cols}
+
+    return pv.open_csv(
+        csv_path,
+        read_options=pv.ReadOptions(
+            block_size=BLOCK_SIZE, encoding=enc, column_names=header, skip_rows=1
+        ),
+        convert_options=pv.ConvertOptions(
+            column_types=col_types,
+            include_columns=keep_cols,
+            null_values=NULL_VALUES,
+            strings_can_be_null=True
+        )
+    )
+
+
+# Приведение строковой колонки к float64
+# Пробелы по краям значений отбрасываются; если колонка не приводится целиком,
+# из значений удаляются разделители тысяч, а значения, которые все равно не являются
+# числами, становятся пропусками (как pd.to_numeric(..., errors="coerce")),
+# и удаляются только эти строки
+def _to_float(values):
+    values = pc.utf8_trim_whitespace(values)
+    try:
+        return pc.cast(values, pa.float64())
+    except pa.ArrowInvalid:
+        values = pc.replace_substring(values, ",", "")
+        is_number = pc.match_substring_regex(values, NUMBER_PATTERN)
+        return pc.cast(pc.if_else(is_number, values, pa.scalar(None, pa.string())), pa.float64())
 
-            # Для каждого фрагмента данных
-            for batch in reader:
-                # Удаление пробелов из названий колонок
-                batch.columns = batch.columns.str.strip()
-                # Замена бесконечных значений на NaN
-                batch.replace([np.inf, -np.inf], np.nan, inplace=True)
-                # Удаление NaN значений
-                batch.dropna(inplace=True)
 
-                # Пропуск блока, если все строки были NaN
-                if batch.empty:
-                    continue
+# Ошибка декодирования текста в выбранной кодировке
+# (arrow сообщает о некорректном UTF-8 через ArrowInvalid)
+def _is_decode_error(exc):
+    if isinstance(exc, UnicodeDecodeError):
+        return True
+    return isinstance(exc, pa.ArrowInvalid) and "UTF8" in str(exc)
 
-                # Удаление лишних колонок
-                batch.drop(columns=[col for col in DROP_COLS if col in batch], inplace=True)
 
-                # Поиск колонки с временными метками
-                time_col = next((col for col in batch.columns if "Timestamp" in col), None)
-
-                # Если такой нет, файл обработать нельзя (для snn нужны временные метки)
-                if time_col is None:
-                    prcs_ok = False
-                    break
+# Обработка и запись в parquet всех блоков одного csv-файла
+def _process_batches(
+        reader,                 # потоковый читатель csv-файла
+        col_names,              # наименования колонок после очистки
+        writer,                 # объект для записи данных в parquet
+        num_cols,               # список наименований числовых признаков
+        global_minmax           # массив (2, len(num_cols)) min/max значений числовых признаков
+    ):
+    # Колонки, попадающие в итоговую схему (остальные пропускаются)
+    keep_cols = [name for name in col_names if name in ("Timestamp", "Label") or name in num_cols]
+    # Для каждого блока данных
+    for record_batch in reader:
+        # Приведение числовых признаков к float64
+        record_batch = pa.RecordBatch.from_arrays(
+            [
+                col if name in ("Timestamp", "Label") else _to_float(col)
+                for name, col in zip(col_names, record_batch.columns)
+                if name in keep_cols
+            ],
+            names=keep_cols
+        )
+        # Удаление NaN, бесконечных и некорректных значений (прочитаны как пропуски)
+        record_batch = record_batch.drop_null()
+
+        # Группировка типов записей по 7 группам (6 видов атак + normal)
+        # (индекс исходной метки в LABEL_MAP, для неизвестных меток - пропуск)
+        label_idx = pc.index_in(record_batch.column("Label"), value_set=LABEL_KEYS)
+        # Остаются строки с известными метками и конечными значениями признаков
+        mask = functools.reduce(
+            pc.and_,
+            [pc.is_finite(record_batch.column(col)) for col in num_cols],
+            pc.is_valid(label_idx)
+        )
+        record_batch = record_batch.filter(mask)
+
+        # Пропуск блока, если все строки были удалены
+        if record_batch.num_rows == 0:
+            continue
 
-                # Приведение значений в колонке временных меток в тип datetime
-                batch[time_col] = pd.to_datetime(batch[time_col], errors="coerce")
-                batch.rename(columns={time_col: "Timestamp"}, inplace=True)
-                # Удаление строк где не получилось обработать время
-                batch.dropna(subset=["Timestamp"], inplace=True)
-                if batch.empty:
-                    continue
+        # Метки хранятся как категории (коды групп + словарь LABEL_GROUPS)
+        label_pos = record_batch.schema.get_field_index("Label")
+        labels = pa.DictionaryArray.from_arrays(
+            pc.take(LABEL_CODES, label_idx.filter(mask)), pa.array(LABEL_GROUPS)
+        )
+        record_batch = record_batch.set_column(label_pos, "Label", labels)
+        batch = record_batch.to_pandas()
+
+        # Приведение значений в колонке временных меток в тип datetime
+        batch["Timestamp"] = pd.to_datetime(batch["Timestamp"], errors="coerce")
+        # Удаление строк где не получилось обработать время
+        batch.dropna(subset=["Timestamp"], inplace=True)
+        if batch.empty:
+            continue
+        # Временные метки хранятся как int64 (наносекунды с начала эпохи)
+        batch["Timestamp"] = _to_epoch_ns(batch["Timestamp"])
 
-                # Файлы без меток трафика тоже нельзя обработать
-                if "Label" not in batch.columns:
-                    prcs_ok = False
-                    break
+        # Ограничение и логарифмирование значений
+        batch, col_min, col_max = _scale_features(batch, num_cols)
 
-                # Группировка типов записей по 7 группам (6 видов атак + normal)
-                batch["Label"] = batch["Label"].map(LABEL_MAP)
-                batch.dropna(subset=["Label"], inplace=True)
-                if batch.empty:
-                    continue
+        # Сохранение новых диапазонов возможных значений
+        np.minimum(global_minmax[0], col_min, out=global_minmax[0])
+        np.maximum(global_minmax[1], col_max, out=global_minmax[1])
 
-                # Колонки с числовыми признаками приводятся к float64
-                int_cols = batch.select_dtypes(include=["int", "int64", "int32"]).columns
-                batch[int_cols] = batch[int_cols].astype("float64")
-
-                # Колонки с категориальными - к числовым
-                obj_cols = [
-                    col for col in batch.select_dtypes(include=["object"]).columns
-                    if col not in ("Timestamp", "Label")
-                ]
-                for col in obj_cols:
-                    batch[col] = pd.to_numeric(batch[col].str.replace(',', ''), errors="coerce")
-                batch.dropna(inplace=True)
-                if batch.empty:
-                    continue
+        writer.write_batch(
+            pa.RecordBatch.from_pandas(batch, schema=writer.schema, preserve_index=False)
+        )
 
-                # Ограничение и логарифмирование значений
-                num_cols = batch.select_dtypes(include=[np.number]).columns
-                batch = _clip_by_percentiles(batch, num_cols)
-                batch = _log_and_clip_scaling(batch, num_cols)
 
-                # Сохранение новых диапазонов возможных значений
-                for col in num_cols:
-                    val_min, val_max = float(batch[col].min()), float(batch[col].max())
-                    if col not in global_minmax:
-                        global_minmax[col] = [val_min, val_max]
-                    else:
-                        global_minmax[col][0] = min(global_minmax[col][0], val_min)
-                        global_minmax[col][1] = max(global_minmax[col][1], val_max)
+# Обработка одного csv-файла с сохранением результата в отдельный parquet
+# Возвращает массив (2, len(num_cols)) min/max значений числовых признаков в файле
+# или None, если файл обработать не удалось
+def _process_csv(
+        csv_path,               # путь к одному из csv-файлов исходного датасета
+        out_path,               # путь для сохранения обработанного файла
+        schema,                 # схема parquet-файла
+        num_cols                # список наименований числовых признаков
+    ):
+    print(f"[PROCESS] Обрабатывается {csv_path.name}")
 
-                writer.write_table(pa.Table.from_pandas(batch, preserve_index=False))
+    # Перебор возможных кодировок
+    for enc in POSSIBLE_ENCODINGS:
+        # Диапазоны значений числовых признаков в файле
+        local_minmax = np.array([np.full(len(num_cols), np.inf), np.full(len(num_cols), -np.inf)])
+        try:
+            # Флаг корректной обработки данных
+            prcs_ok = True
 
-        except UnicodeDecodeError:
+            # Потоковое чтение файла блоками размером BLOCK_SIZE
+            reader = _open_csv(csv_path, enc)
+
+            # Удаление пробелов из названий колонок
+            col_names = [col.strip() for col in reader.schema.names]
+            # Поиск колонки с временными метками
+            time_col = next((col for col in col_names if "Timestamp" in col), None)
+
+            # Если такой нет, файл обработать нельзя (для snn нужны временные метки)
+            # Файлы без меток трафика тоже нельзя обработать
+            if time_col is None or "Label" not in col_names:
+                prcs_ok = False
+            else:
+                col_names[col_names.index(time_col)] = "Timestamp"
+                # Обработка и запись всех блоков файла
+                # (при переходе к другой кодировке файл перезаписывается)
+                with pq.ParquetWriter(out_path, schema, compression="snappy") as writer:
+                    _process_batches(reader, col_names, writer, num_cols, local_minmax)
+
+        except (UnicodeDecodeError, pa.ArrowInvalid) as exc:
+            # К следующей кодировке переходим только при ошибке декодирования
+            if not _is_decode_error(exc):
+                raise
             prcs_ok = False
         if prcs_ok:
             break
@@ -211,6 +397,9 @@ def _process_csv(
             continue
     else:
         print(f"[ERROR] Невозможно обработать {csv_path.name}")
+        out_path.unlink(missing_ok=True)
+        return None
+    return local_minmax
 
 
 
@@ -251,20 +440,71 @@ def prepare(rewrite=False):
     for col in obj_col:
         df_prev[col] = pd.to_numeric(df_prev[col].str.replace(',', ''), errors="coerce")
     df_prev.dropna(inplace=True)
-    nums = df_prev.select_dtypes(include=[np.number]).columns
-    df_prev = _clip_by_percentiles(df_prev, nums)
-    df_prev = _log_and_clip_scaling(df_prev, nums)
+    if time_col:
+        df_prev["Timestamp"] = _to_epoch_ns(df_prev["Timestamp"])
+    if "Label" in df_prev:
+        df_prev["Label"] = pd.Categorical(df_prev["Label"].map(LABEL_MAP), categories=LABEL_GROUPS)
+    # Временные метки (int64) не относятся к признакам
+    nums = df_prev.select_dtypes(include=[np.number]).columns.drop("Timestamp", errors="ignore")
+    df_prev, _, _ = _scale_features(df_prev, nums)
 
     # Составление схему
     schema = pa.Table.from_pandas(df_prev[:1], preserve_index=False).schema
+    # Пометка о формате временных меток
+    schema = schema.with_metadata({**(schema.metadata or {}), **TIMESTAMP_METADATA})
+    # Метки хранятся словарем с фиксированным типом значений
+    # (совпадает с типом, который parquet восстанавливает при чтении)
+    label_pos = schema.get_field_index("Label")
+    if label_pos != -1:
+        schema = schema.set(label_pos, pa.field("Label", pa.dictionary(pa.int8(), pa.string())))
 
     # Обработка всех файлов и сохранение новых диапазонов и чистого датасета
-    global_minmax = {}
-    with pq.ParquetWriter(out_parquet, schema, compression="snappy") as writer:
-        for csv_path in csv_files:
-            _process_csv(csv_path, writer, global_minmax)
+    # Порядок числовых признаков фиксируется по схеме
+    num_cols = list(nums)
+    global_minmax = np.array([np.full(len(num_cols), np.inf), np.full(len(num_cols), -np.inf)])
+
+    # Файлы обрабатываются параллельно, каждый во временный parquet
+    # (временный каталог удаляется и при ошибке в процессе обработки)
+    with tempfile.TemporaryDirectory(dir=CLEAN_DIR) as tmp_dir:
+        tmp_paths = [pathlib.Path(tmp_dir) / f"{csv_path.stem}.parquet" for csv_path in csv_files]
+        n_workers = min(len(csv_files), os.cpu_count() or 1)
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            # Ядра делятся между процессами, чтобы numba-ядра не конкурировали за потоки
+            initializer=set_num_threads,
+            initargs=(max(1, (os.cpu_count() or 1) // n_workers),)
+        ) as executor:
+            local_minmaxes = list(executor.map(
+                _process_csv, csv_files, tmp_paths, repeat(schema), repeat(num_cols)
+            ))
+
+        # Объединение временных файлов в исходном порядке и слияние диапазонов
+        with pq.ParquetWriter(out_parquet, schema, **PARQUET_OPTIONS) as writer:
+            for tmp_path, local_minmax in zip(tmp_paths, local_minmaxes):
+                if local_minmax is None:
+                    continue
+                np.minimum(global_minmax[0], local_minmax[0], out=global_minmax[0])
+                np.maximum(global_minmax[1], local_minmax[1], out=global_minmax[1])
+                for batch in pq.ParquetFile(tmp_path).iter_batches():
+                    writer.write_batch(batch)
     with out_ranges.open("w", encoding="utf-8") as fp:
-        json.dump(global_minmax, fp, ensure_ascii=False, indent=2)
+        # Диапазоны признаков, встретившихся хотя бы в одном блоке
+        feature_ranges = {
+            col: [float(val_min), float(val_max)]
+            for col, val_min, val_max in zip(num_cols, *global_minmax)
+            if val_min <= val_max
+        }
+        json.dump(feature_ranges, fp, ensure_ascii=False, indent=2)
+    # Те же диапазоны в виде массивов, упорядоченных по наименованию признака
+    # (json остается для просмотра)
+    names = sorted(feature_ranges)
+    np.savez(
+        out_ranges.with_suffix(".npz"),
+        names=np.array(names),
+        lo=np.array([feature_ranges[name][0] for name in names], dtype=np.float64),
+        hi=np.array([feature_ranges[name][1] for name in names], dtype=np.float64)
+    )
 
     print(f"[DONE] Сохранены в {CLEAN_DIR}")
 
@@ -2,6 +2,7 @@ import argparse
 import logging
 import sys
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
 
@@ -18,6 +19,15 @@ TEST_SHARE = 0.25
 TIME_COL = "Timestamp"
 # Наименование колонки с типом трафика
 LABEL_COL = "Label"
+# Параметры записи train/test parquet-файлов (те же, что и в prepare_dataset.py;
+# скрипт запускается отдельно, поэтому параметры не импортируются)
+PARQUET_OPTIONS = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "use_dictionary": [LABEL_COL],
+    "data_page_size": 1 << 20,
+    "write_statistics": True
+}
 # Формат для записи логов
 LOG_FORMAT = "[%(levelname)s] %(message)s"
 
@@ -32,22 +42,35 @@ def load_df(path):
     # Датасет должен обязательно содержать метки времени и метки трафика
     if TIME_COL not in df.columns or LABEL_COL not in df.columns:
         raise KeyError(f"Файл поврежден: отсутствуют {TIME_COL} или {LABEL_COL}")
-    # Приведение значений в колонке с временными метками к типу datetime
-    df[TIME_COL] = pd.to_datetime(df[TIME_COL], errors="coerce")
+    # Временные метки уже хранятся как int64 (наносекунды с начала эпохи),
+    # повторное преобразование к datetime не нужно
     # Удаление строк с битыми TIME_COL и/или LABEL_COL
     df.dropna(subset=[TIME_COL, LABEL_COL], inplace=True)
+    # Метки трафика хранятся как категории (операции над ними - над целочисленными кодами)
+    df[LABEL_COL] = df[LABEL_COL].astype("category")
     return df
 
 
 
+# Коды меток трафика, их категории и количество строк каждой категории
+def _label_counts(df):
+    labels = df[LABEL_COL].cat
+    codes = labels.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(labels.categories))
+    return codes, labels.categories, counts
+
+
+
 # Удаление классов с количеством записей меньше FREQ_TH
 def drop_rare_rows(df):
     # Вычисление количества строк для каждого класса
-    count_rows = df[LABEL_COL].value_counts()
-    # Получение имен классов с размером меньше FREQ_TH
-    rare_labels = count_rows[count_rows < FREQ_TH].index.tolist()
-    # Создание датасета без редких классов
-    new_df = df[~df[LABEL_COL].isin(rare_labels)].copy()
+    codes, categories, counts = _label_counts(df)
+    # Получение кодов и имен классов с размером меньше FREQ_TH
+    rare_codes = np.flatnonzero((counts > 0) & (counts < FREQ_TH))
+    rare_labels = categories[rare_codes].tolist()
+    # Создание датасета без редких классов (удаленные классы убираются и из категорий)
+    new_df = df[~np.isin(codes, rare_codes)].copy()
+    new_df[LABEL_COL] = new_df[LABEL_COL].cat.remove_unused_categories()
     if rare_labels:
         logging.info(f"Удалены редкие классы: {rare_labels}")
     return new_df, rare_labels
@@ -56,17 +79,22 @@ def drop_rare_rows(df):
 
 # Разделение очищенного датасета на train и test
 def split_by_label_and_time(df):
+    # Коды классов в порядке первого появления
+    codes, labels = pd.factorize(df[LABEL_COL], sort=False)
+    # Одна общая сортировка: по классу, внутри класса - по времени (стабильная)
+    order = np.lexsort((df[TIME_COL].to_numpy(), codes))
+    df = df.iloc[order]
+    # Границы блоков строк одного класса в отсортированном датасете
+    bounds = np.searchsorted(codes[order], np.arange(len(labels) + 1))
     # Списки для хранения блоков обучающей и тестовой выборки
     train_parts, test_parts = [], []
-    # Цикл по группам строк одного класса
-    for _, group in df.groupby(LABEL_COL, sort=False):
-        # Сортировка по времени
-        group = group.sort_values(TIME_COL)
+    # Цикл по блокам строк одного класса
+    for start, end in zip(bounds[:-1], bounds[1:]):
         # Количество записей этого класса, которые должны попасть в тестовую выборку
-        n_test = max(1, int(len(group) * TEST_SHARE))
+        n_test = max(1, int((end - start) * TEST_SHARE))
         # Последние n_test строк в тестовую выборку, остальные в обучающую
-        test_parts.append(group.tail(n_test))
-        train_parts.append(group.iloc[:-n_test])
+        test_parts.append(df.iloc[end - n_test:end])
+        train_parts.append(df.iloc[start:end - n_test])
     # Объединение кусков внутри датасетов со сбросом старых индексов
     train_df = pd.concat(train_parts).reset_index(drop=True)
     test_df = pd.concat(test_parts).reset_index(drop=True)
@@ -80,39 +108,45 @@ def undersample_majority(
         random_state=42     # инициализация генератора случайных чисел
     ):
     # Вычисление количества строк для каждого класса в тренировочном датасете
-    count_rows = train_df[LABEL_COL].value_counts()
+    codes, categories, counts = _label_counts(train_df)
     # Если нет записей класса Normal, то пропускаем
-    if "Normal" not in count_rows:
+    if "Normal" not in categories or counts[categories.get_loc("Normal")] == 0:
         logging.warning("Класс Normal не найден. Балансировка пропущена.")
         return train_df
+    normal_code = categories.get_loc("Normal")
     # Целевой размер класса Normal - размер максимального класса из Attack
-    target_size = count_rows.drop("Normal").max()
+    target_size = int(np.delete(counts, normal_code).max(initial=0))
+    # Если записей классов Attack нет, то пропускаем (иначе удалился бы весь Normal)
+    if target_size == 0:
+        logging.warning("Классы Attack не найдены. Балансировка пропущена.")
+        return train_df
+    cnt_r = int(counts[normal_code])
     # Считаем количество строк, которые нужно удалить
-    need_remove = count_rows["Normal"] - target_size
-    cnt_r = count_rows["Normal"]
+    need_remove = cnt_r - target_size
     # Если разность между текущим и целевым размером класса неположительна
     if need_remove <= 0:
         # Пропускаем балансировку
         logging.info(f"Балансировка не нужна ({cnt_r} <= {target_size})")
         return train_df
-    # Формирование списка индексов строк, которые нужно оставить
-    keep_idx = (
-        train_df[train_df[LABEL_COL] == "Normal"]
-        .sample(n=target_size, random_state=random_state)       # случайный выбор target_size строк Normal
-        .index                                                  # все строки остальных классов оставляем
-        .union(train_df[train_df[LABEL_COL] != "Normal"].index) # объединяем эти индексы в единый набор
-    )
+    # Позиции строк класса Normal
+    normal_idx = np.flatnonzero(codes == normal_code)
+    # Случайный выбор need_remove строк Normal, которые нужно удалить
+    rng = np.random.default_rng(random_state)
+    drop_idx = rng.choice(normal_idx, size=need_remove, replace=False)
+    # Маска строк, которые нужно оставить (все строки остальных классов оставляем)
+    keep_mask = np.ones(len(train_df), dtype=bool)
+    keep_mask[drop_idx] = False
     logging.info(f"Количество строк в классе Normal: {cnt_r} -> {target_size}")
     # Возвращаем итоговую таблицу со сбросом индексов
-    return train_df.loc[keep_idx].sample(frac=1.0, random_state=random_state).reset_index(drop=True)
+    return train_df.iloc[keep_mask].sample(frac=1.0, random_state=random_state).reset_index(drop=True)
 
 
 
 # Сохранение parquet-файлов
 def save_parquets(train_df, test_df, out_dir):
     out_dir.mkdir(parents=True, exist_ok=True)
-    train_df.to_parquet(out_dir / "train.parquet", compression="snappy", engine="pyarrow")
-    test_df.to_parquet(out_dir / "test.parquet",  compression="snappy", engine="pyarrow")
+    train_df.to_parquet(out_dir / "train.parquet", engine="pyarrow", **PARQUET_OPTIONS)
+    test_df.to_parquet(out_dir / "test.parquet", engine="pyarrow", **PARQUET_OPTIONS)
     logging.info(f"Сохранено в {out_dir}")
 
 